@@ -1,44 +1,60 @@
 import re
 import fnmatch
+from collections import deque
+from ast import literal_eval
 from parsource.tree import Node
-from typing import List, Tuple, Optional, Any, Union, NamedTuple, Dict
+from typing import List, Tuple, Optional, Any, Union, NamedTuple, Dict, Callable, FrozenSet, Iterator, Deque
 
 # --
 # This is a simple tree-representation parser, so that the output of
 # tree can be parsed back into a tree structure.
 
 # NOTE: Merge this in tree
-RE_NODE = re.compile(r"^(?P<indent>[├─└ ]*)(?P<name>[\w\-_]+)(?P<attrs>.*)?$")
+RE_NODE = re.compile(r"^(?P<name>[\w\-_]+)(?P<attrs>.*)?$", re.ASCII)
+# The characters used by `Node.iterTDoc` to indent the nodes
+TDOC_INDENT = "├─└│ "
+
+
+def parseValue(text: str) -> Any:
+    """Parses an attribute value, which is a Python literal. Quoted strings
+    without escapes are sliced directly."""
+    quote = text[:1]
+    if len(text) > 1 and quote in "'\"" and text[-1] == quote and "\\" not in text and quote not in text[1:-1]:
+        return text[1:-1]
+    else:
+        return literal_eval(text)
 
 
 def parse(text):
     """A simple TDoc parser"""
-    stack: List[Tuple[int, Node]] = []
-    indent = 0
-    for line in text.split("\n"):
-        match = RE_NODE.match(line)
+    # The stack holds the `(indent, node)` of the current ancestors
+    stack: Deque[Tuple[int, Node]] = deque()
+    root: Optional[Node] = None
+    for line in text.splitlines():
+        # We strip the indentation directly, so that the regexp only
+        # matches the node itself.
+        stripped = line.lstrip(TDOC_INDENT)
+        match = RE_NODE.match(stripped)
         if not match:
             continue
         name = match.group("name")
         raw_attrs = [attr.strip().split("=")
                      for attr in (match.group("attrs") or "").split(" ") if attr.strip()]
-        attrs = dict((_[0], eval(_[1])) for _ in raw_attrs)
-        i = len(match.group("indent"))
+        attrs = dict((_[0], parseValue(_[1])) for _ in raw_attrs)
+        i = len(line) - len(stripped)
         node = Node(name, **attrs)
-        if not stack:
-            stack.append((i, node))
-        elif i == indent:
-            stack[-2][1].append(node)
-        elif i > indent:
+        # We pop the siblings and their descendants, so that the parent
+        # is at the top of the stack.
+        while stack and stack[-1][0] >= i:
+            stack.pop()
+        if stack:
             stack[-1][1].append(node)
-            stack.append((i, node))
+        elif root is not None:
+            root.append(node)
         else:
-            while stack[-1][0] >= i:
-                stack.pop()
-            assert stack
-            stack.append((indent, node))
-        indent = i
-    return stack[0][1]
+            root = node
+        stack.append((i, node))
+    return root
 
 
 # --
@@ -48,18 +64,65 @@ def parse(text):
 
 Match = NamedTuple("Match", [("pattern", 'Pattern'),
                              ("value", Union[Node, List['Match']]), ("slot", Optional[str])])
+Matcher = Callable[[Node], Optional[Match]]
+Memo = Dict[Tuple[int, int], Optional[Match]]
+
+
+def siblingsOf(node: Node) -> List[Node]:
+    """Returns the list of children the node is part of."""
+    return node.parent.children if node.parent else [node]
+
+
+def memoized(pattern: 'Pattern', matcher: Matcher, memo: Optional[Memo]) -> Matcher:
+    """Wraps the given matcher so that its results are stored in `memo`,
+    by pattern and node id. This is the packrat parsing trick, as compound
+    patterns are tried on the same nodes many times."""
+    if memo is None:
+        return matcher
+
+    def memo_matcher(node: Node, key=id(pattern)) -> Optional[Match]:
+        k = (key, node.id)
+        if k not in memo:
+            memo[k] = matcher(node)
+        return memo[k]
+    return memo_matcher
 
 
 class Pattern:
 
+    # Incremented whenever a pattern changes, as compiled matchers capture
+    # the slots and sub-patterns of the patterns they were compiled from.
+    REVISION = 0
+
     def __init__(self):
         self.slot: Optional[str] = None
+        # The `(revision, matcher)` returned by `compiled`
+        self._compiled: Optional[Tuple[int, Matcher]] = None
 
     def match(self, node: Node) -> Any:
         raise NotImplementedError
 
+    def firstNames(self) -> Optional[FrozenSet[str]]:
+        """Returns the set of node names that the first matched node can
+        have, or `None` if any name might match."""
+        return None
+
+    def compile(self, memo: Optional[Memo] = None) -> Matcher:
+        """Returns a function that matches a node like `match` does, where
+        the dispatching on the pattern structure has been done once. Compound
+        patterns store their results in the `memo`, when given."""
+        return self.match
+
+    def compiled(self) -> Matcher:
+        """Returns the matcher compiled without a memo, which is cached
+        until any pattern changes."""
+        if not self._compiled or self._compiled[0] != Pattern.REVISION:
+            self._compiled = (Pattern.REVISION, self.compile())
+        return self._compiled[1]
+
     def __getitem__(self, key: str) -> 'Pattern':
         self.slot = key
+        Pattern.REVISION += 1
         return self
 
     def __add__(self, other) -> 'Pattern':
@@ -72,9 +135,22 @@ class WithName(Pattern):
     def __init__(self, name: str):
         super().__init__()
         self.name = name
+        self.isGlob = any(_ in name for _ in "*?[")
+        # We translate the glob once, and use plain equality when the name
+        # has no glob special characters.
+        self._match: Callable[[str], Any] = re.compile(fnmatch.translate(
+            name)).match if self.isGlob else name.__eq__
 
     def match(self, node: Node) -> Optional[Match]:
-        return Match(self, self.slot, node) if fnmatch.fnmatch(node.name, self.name) else None
+        return Match(self, node, self.slot) if self._match(node.name) else None
+
+    def firstNames(self) -> Optional[FrozenSet[str]]:
+        return None if self.isGlob else frozenset((self.name,))
+
+    def compile(self, memo: Optional[Memo] = None) -> Matcher:
+        def matcher(node: Node, match=self._match, pattern=self, slot=self.slot) -> Optional[Match]:
+            return Match(pattern, node, slot) if match(node.name) else None
+        return matcher
 
 
 class PatternOf(Pattern):
@@ -89,21 +165,43 @@ class PatternOf(Pattern):
 
 class SeqOf(PatternOf):
 
+    def __init__(self, *patterns: Pattern):
+        super().__init__(*patterns)
+        # The first pattern never changes, as `+` appends, so we can
+        # cache the names that can start the sequence.
+        self._firstNames = self.of[0].firstNames() if self.of else None
+
+    def firstNames(self) -> Optional[FrozenSet[str]]:
+        return self._firstNames
+
     def match(self, node: Node) -> Optional[Match]:
-        res: List[Node] = []
-        cur: Optional[Node] = node
-        for pat in self.of:
-            if not cur:
+        return self.compiled()(node)
+
+    def compile(self, memo: Optional[Memo] = None) -> Matcher:
+        matchers = [_.compile(memo) for _ in self.of]
+
+        def matcher(node: Node, pattern=self, slot=self.slot, names=self._firstNames) -> Optional[Match]:
+            # We don't try the sub-patterns if the first node can't match
+            if names is not None and node.name not in names:
                 return None
-            elif not (match := pat.match(cur)):
+            # We iterate on the siblings list directly, rather than going
+            # through `nextSibling` for each sub-pattern.
+            siblings = siblingsOf(node)
+            offset = node.index() or 0
+            if offset + len(matchers) > len(siblings):
                 return None
-            res.append(match)
-            cur = cur.nextSibling
-        return Match(self, res, self.slot)
+            res: List[Match] = []
+            for cur, match in zip(siblings[offset:], matchers):
+                if not (m := match(cur)):
+                    return None
+                res.append(m)
+            return Match(pattern, res, slot)
+        return memoized(self, matcher, memo)
 
     def __add__(self, other) -> 'Pattern':
         pat = other if isinstance(other, Pattern) else WithName(other)
         self.of.append(pat)
+        Pattern.REVISION += 1
         return self
 
 
@@ -112,12 +210,36 @@ class AnyOf(Pattern):
     def __init__(self, *patterns: Pattern):
         super().__init__()
         self.of: List[Pattern] = [_ for _ in patterns]
+        # We group the alternatives by the names of their first node, so
+        # that only the alternatives that can match a given node name are
+        # tried, in their original order. The alternatives that might
+        # match any name are tried for every node.
+        alternatives = [(_.firstNames(), _) for _ in self.of]
+        self._anyName: List[Pattern] = [
+            pat for names, pat in alternatives if names is None]
+        self._byFirstName: Dict[str, List[Pattern]] = {}
+        for name in set().union(*(names for names, _ in alternatives if names)):
+            self._byFirstName[name] = [
+                pat for names, pat in alternatives if names is None or name in names]
 
     def match(self, node: Node) -> Optional[Match]:
-        for pat in self.of:
-            if (res := pat.match(node)):
-                return Match(self, res, self.slot)
-        return None
+        return self.compiled()(node)
+
+    def firstNames(self) -> Optional[FrozenSet[str]]:
+        return None if self._anyName else frozenset(self._byFirstName)
+
+    def compile(self, memo: Optional[Memo] = None) -> Matcher:
+        compiled = dict((id(_), _.compile(memo)) for _ in self.of)
+        fallback = [compiled[id(_)] for _ in self._anyName]
+        table: Dict[str, List[Matcher]] = dict(
+            (name, [compiled[id(_)] for _ in pats]) for name, pats in self._byFirstName.items())
+
+        def matcher(node: Node, pattern=self, slot=self.slot) -> Optional[Match]:
+            for match in table.get(node.name, fallback):
+                if (res := match(node)):
+                    return Match(pattern, res, slot)
+            return None
+        return memoized(self, matcher, memo)
 
 # --
 # And a declarative API to take care of it.
@@ -127,11 +249,16 @@ def named(name):
     return WithName(name)
 
 
-def find(pattern: Pattern, tree: Node):
-    for node in tree.walk():
-        if match := pattern.match(node):
-            # TODO: Should be a yield
-            return match
+def find(pattern: Pattern, tree: Node) -> Iterator[Match]:
+    """Yields the matches of the given pattern in the tree. Only the nodes
+    with a name that can start the pattern are tried, and the matches of
+    sub-patterns are memoized for the duration of the search."""
+    names = pattern.firstNames()
+    matcher = pattern.compile({})
+    for node in tree.iterWalk():
+        if names is None or node.name in names:
+            if match := matcher(node):
+                yield match
 
 
 TSlots = Dict[str, Union[Node, List[Node]]]
@@ -144,13 +271,10 @@ def slots(match: Match) -> TSlots:
         if not value:
             return value
         if isinstance(value, Node):
-            print("NODE", value)
             res = value
         elif isinstance(value, List):
-            print("LIST", value)
             res = [helper(_, slots) for _ in value]
         else:
-            print("MATCH", value)
             # We have a match
             match = value
             res = helper(match.value, slots)
@@ -171,6 +295,6 @@ root
 """)
 Expr = named("text")["left"] + named("op-inf")["op"] + named("text")["right"]
 
-match = find(Expr, TREE)
+match = next(find(Expr, TREE))
 print(match)
 print(slots(match))
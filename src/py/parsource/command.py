@@ -1,15 +1,21 @@
-from parsource import Parser
-from parsource.lang.js import JavaScript
+from parsource import BlockParser
+from parsource.lang.js import JavaScriptBlocks
 from parsource.transform import TreeExtractor
 import sys
 
 
 def run(args=sys.argv[1:]):
+    parser = BlockParser(JavaScriptBlocks())
+    extractor = TreeExtractor()
     for a in args:
         with open(a, "rt") as f:
-            extractor = TreeExtractor()
-            for error in extractor.process(JavaScript.parse(f.read())):
-                print("ERROR", error)
-            print(extractor.value.toTDoc())
+            text = f.read()
+        extractor.reset()
+        for error in extractor.process(parser.parse(text)):
+            print("ERROR", error)
+        # We don't need the source anymore, and we write the TDoc lines as
+        # they are produced instead of building the whole string.
+        del text
+        extractor.value.writeTDoc(sys.stdout)
 
 # EOF
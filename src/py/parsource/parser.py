@@ -1,4 +1,8 @@
-from typing import Iterable, Tuple, Any, Iterable, Optional, Dict, List, Pattern, Match, Union, NamedTuple
+import re
+import heapq
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Iterable, Tuple, Any, Iterable, Optional, Dict, List, Mapping, Pattern, Match, Union, NamedTuple
 
 
 # --
@@ -43,25 +47,37 @@ class BlockLanguage:
         self.comments = self.COMMENTS
         self.blocks = self.BLOCKS
         self.quotes = self.QUOTES
-        self.blockStart = [_[0] for _ in self.blocks]
-        self.blockEnd = [_[1] for _ in self.blocks]
-        self.blockMatch = dict(
-            [(k, v) for k, v in self.blocks] + [(v, k) for k, v in self.blocks])
-        self.delimiters = [self.escape] + self.comments + self.blockStart + \
-            self.blockEnd + self.quotes + self.lineEnd + self.statementEnd
-
+        # The derived tables only depend on the class, so they are computed
+        # once and shared by all the instances.
+        (self.blockStart, self.blockEnd, self.blockMatch, self.delimiters,
+         self.events, self.delimitersPattern) = self.Tables()
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def Tables(cls) -> Tuple[Tuple[str, ...], Tuple[str, ...], Mapping[str, str], Tuple[str, ...], Mapping[str, str], Optional[Pattern]]:
+        """Returns the `(blockStart, blockEnd, blockMatch, delimiters, events,
+        delimitersPattern)` tables derived from the class definition."""
+        block_start = tuple(_[0] for _ in cls.BLOCKS)
+        block_end = tuple(_[1] for _ in cls.BLOCKS)
+        block_match = dict(
+            [(k, v) for k, v in cls.BLOCKS] + [(v, k) for k, v in cls.BLOCKS])
+        delimiters = (cls.ESCAPE,) + tuple(cls.COMMENTS) + block_start + \
+            block_end + tuple(cls.QUOTES) + \
+            tuple(cls.LINE_END) + tuple(cls.STATEMENT_END)
         # Now we pre-calculate the events map, for speed
-        self.events: Dict[str, str] = {}
+        events: Dict[str, str] = {}
         for delims, event_type in (
-                (self.comments,     ParseEvent.COMMENT),
-                (self.lineEnd,      ParseEvent.LINE_END),
-                (self.statementEnd, ParseEvent.STATEMENT_END),
-                (self.blockStart,   ParseEvent.BLOCK_START),
-                (self.blockEnd,     ParseEvent.BLOCK_END),
-                (self.quotes,       ParseEvent.QUOTE),
+                (cls.COMMENTS,      ParseEvent.COMMENT),
+                (cls.LINE_END,      ParseEvent.LINE_END),
+                (cls.STATEMENT_END, ParseEvent.STATEMENT_END),
+                (block_start,       ParseEvent.BLOCK_START),
+                (block_end,         ParseEvent.BLOCK_END),
+                (cls.QUOTES,        ParseEvent.QUOTE),
         ):
             for delim in delims:
-                self.events[delim] = event_type
+                events[delim] = event_type
+        return (block_start, block_end, MappingProxyType(block_match), delimiters,
+                MappingProxyType(events), compileDelimiters(delimiters, cls.ESCAPE))
 
 
 class ExpressionLanguage:
@@ -83,9 +99,33 @@ class ExpressionLanguage:
         self.opInfix = self.OPERATOR_INFIX
         self.opPrefix = self.OPERATOR_PREFIX
         self.opSuffix = self.OPERATOR_SUFFIX
-        self.operators = self.opInfix + self.opPrefix + self.opSuffix
-        self.delimiters = self.separators + self.keywords + \
-            self.opInfix + self.opPrefix + self.opSuffix
+        # Like for blocks, the derived tables are shared by all the instances
+        (self.operators, self.delimiters, self.events,
+         self.delimitersPattern) = self.Tables()
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def Tables(cls) -> Tuple[Tuple[str, ...], Tuple[str, ...], Mapping[str, Optional[str]], Optional[Pattern]]:
+        """Returns the `(operators, delimiters, events, delimitersPattern)`
+        tables derived from the class definition."""
+        operators = tuple(cls.OPERATOR_INFIX) + \
+            tuple(cls.OPERATOR_PREFIX) + tuple(cls.OPERATOR_SUFFIX)
+        delimiters = tuple(cls.SEPARATORS) + tuple(cls.KEYWORDS) + operators
+        # Now we pre-calculate the events map, for speed. Separators map
+        # to no event. We iterate in reverse precedence order, so that the
+        # first category listing a delimiter wins.
+        events: Dict[str, Optional[str]] = {}
+        for delims, event_type in (
+                (cls.SEPARATORS,      None),
+                (cls.OPERATOR_SUFFIX, ParseEvent.OPERATOR_SUFFIX),
+                (cls.OPERATOR_PREFIX, ParseEvent.OPERATOR_PREFIX),
+                (cls.OPERATOR_INFIX,  ParseEvent.OPERATOR_INFIX),
+                (cls.KEYWORDS,        ParseEvent.KEYWORD),
+        ):
+            for delim in delims:
+                events[delim] = event_type
+        return (operators, delimiters, MappingProxyType(events),
+                compileDelimiters(delimiters, cls.ESCAPE))
 
 
 # -----------------------------------------------------------------------------
@@ -110,6 +150,10 @@ class ParseEvent:
     BLOCK_START = ":block-start"
     BLOCK_END = ":block-end"
 
+    # The parser creates one event per delimiter, so we use slots to
+    # keep events small.
+    __slots__ = ("type", "source", "start", "end", "value", "_text")
+
     def __init__(self, type: str, source: str, start: int, end: int, value: Any = None):
         self.type = type
         self.source = source
@@ -120,9 +164,8 @@ class ParseEvent:
 
     @property
     def text(self) -> str:
-        if self._text == None:
+        if self._text is None:
             self._text = self.source[self.start:self.end]
-        assert self._text is not None
         return self._text
 
     def __repr__(self):
@@ -144,39 +187,46 @@ class BlockParser:
 
     def parse(self, text: str) -> Iterable[ParseEvent]:
         """Parses the given text, yielding events."""
-        quote_start: int = -1
-        quote_type: Optional[str] = None
-        for start, end, delim in iterDelimiters(text, self.lang.delimiters, self.lang.escape):
-            # Quotes need to swallow any other delimiter, so that's what we do
-            # here.
-            if quote_type:
-                if delim != quote_type:
-                    # If we're in a quote, we'll swallow any event up until
-                    # we encounter the end quote.
-                    pass
-                else:
-                    # We'll only yield events that are outside of quotes.
-                    quote_type = None
-                    yield ParseEvent(ParseEvent.QUOTE, text, quote_start, end, delim)
-            else:
-                delim_start = end - len(delim)
-                if start < delim_start:
+        # The language tables are fixed, so we bind them to locals once
+        # instead of looking them up for each delimiter.
+        lang = self.lang
+        events = lang.events
+        trim_chars = lang.trim
+        offset = 0
+        n = len(text)
+        while offset < n:
+            for start, end, delim in iterDelimiters(text, lang.delimitersPattern, lang.escape, offset):
+                # We yield the text before the delimiter
+                if offset < start:
                     text_start, text_end = trim(
-                        text, self.lang.trim, start, delim_start)
+                        text, trim_chars, offset, start)
                     if text_start < text_end:
                         yield ParseEvent(ParseEvent.TEXT, text, text_start, text_end)
+                offset = end
                 # The language object will define what is an event type
-                event_type = self.lang.events.get(delim)
-                # If we have a quote, it will start swallowing the other
-                # delimiters.
+                event_type = events.get(delim)
+                # Quotes need to swallow any other delimiter, so we look
+                # for the end quote directly and resume scanning the
+                # delimiters after it.
                 if event_type == ParseEvent.QUOTE:
-                    quote_type = delim
-                    quote_start = delim_start
-                    # We yield the text before the quote
+                    quote_end = findUnescaped(text, delim, end, lang.escape)
+                    # An unterminated quote swallows the rest of the text
+                    offset = n if quote_end < 0 else quote_end + len(delim)
+                    if quote_end >= 0:
+                        yield ParseEvent(ParseEvent.QUOTE, text, start, offset, delim)
+                    break
                 elif event_type:
-                    yield ParseEvent(event_type, text, delim_start, end, delim)
+                    yield ParseEvent(event_type, text, start, end, delim)
                 else:
                     raise ValueError(f"Unknown delimiter {repr(delim)}")
+            else:
+                # We've reached the end of the delimiters, so we yield the
+                # remaining text.
+                if offset < n:
+                    text_start, text_end = trim(text, trim_chars, offset, n)
+                    if text_start < text_end:
+                        yield ParseEvent(ParseEvent.TEXT, text, text_start, text_end)
+                break
 
 
 class ExpressionParser:
@@ -188,23 +238,16 @@ class ExpressionParser:
     def parse(self, text: str) -> Iterable[ParseEvent]:
         """Parses the given text, yielding events."""
         lang = self.lang
+        events = lang.events
         offset = 0
-        for start, end, delim in iterDelimiters(text, lang.delimiters, lang.escape):
+        for start, end, delim in iterDelimiters(text, lang.delimitersPattern, lang.escape):
             if offset < start:
                 yield ParseEvent(ParseEvent.TEXT, text, offset, start)
-            if delim is None:
-                print("REST", text[offset])
-            elif delim in lang.keywords:
-                yield ParseEvent(ParseEvent.KEYWORD, delim, start, end, delim)
-            elif delim in lang.opInfix:
-                yield ParseEvent(ParseEvent.OPERATOR_INFIX, delim, start, end, delim)
-            elif delim in lang.opPrefix:
-                yield ParseEvent(ParseEvent.OPERATOR_PREFIX, delim, start, end, delim)
-            elif delim in lang.opSuffix:
-                yield ParseEvent(ParseEvent.OPERATOR_SUFFIX, delim, start, end, delim)
-            elif delim in lang.separators:
-                pass
-            else:
+            # The language object will define what is an event type, with
+            # separators producing no event.
+            if (event_type := events.get(delim, False)):
+                yield ParseEvent(event_type, text, start, end, delim)
+            elif event_type is False:
                 raise RuntimeError("Unsupported", delim)
             offset = end
         if offset < len(text):
@@ -217,50 +260,51 @@ class ExpressionParser:
 def trim(text: str, trim: str, start: int, end: int) -> Tuple[int, int]:
     """Returns the `(start,end)` offsets in the given text after skipping characters to
     be trimmed from the given `start` and `end` positions."""
-    while start < end and text[start] in trim:
-        start += 1
-    while start < end and text[end - 1] in trim:
-        end -= 1
-    return (start, end)
+    # We let `str.strip` do the scanning, and derive the offsets from
+    # the length of what remains.
+    stripped = text[start:end].lstrip(trim)
+    start = end - len(stripped)
+    return (start, start + len(stripped.rstrip(trim)))
 
 
 DelimiterMatch = NamedTuple(
-    'DelimiterMatch', [("start", int), ("end", int), ("delim", Optional[str])])
+    'DelimiterMatch', [("start", int), ("end", int), ("delim", str)])
+
 
+def compileDelimiters(delimiters: Iterable[str], escape: str) -> Optional[Pattern]:
+    """Compiles the given list of delimiters into a single alternation
+    pattern, so that the text can be scanned in one pass. Longer delimiters
+    come first so that the longest match wins (ie. `!==` over `!=`), and
+    delimiters preceded by the `escape` character are skipped."""
+    if not delimiters:
+        return None
+    alternation = "|".join(re.escape(_) for _ in sorted(
+        set(delimiters), key=len, reverse=True))
+    return re.compile(f"(?<!{re.escape(escape)})(?:{alternation})" if escape else alternation)
 
-def iterDelimiters(text: str, delimiters: List[str], escape: str, lookahead: int = 256) -> Iterable[DelimiterMatch]:
+
+def iterDelimiters(text: str, delimiters: Union[Iterable[str], Pattern, None], escape: str, offset: int = 0) -> Iterable[DelimiterMatch]:
     """Iterates triples `(start,end,delim)` couples for every delimiter that
-    was found up to `lookahead` distance (in characters), choosing the closest
-    one each time. This is essentially like splitting a string based on a list
-    of delimiters, taking into account an `escape` character."""
-    # We start at 0, up until the end of the text
-    offset = 0
-    end = len(text)
-    # While we haven't reached the end
-    while offset < end:
-        i = end
-        d = None
-        # We iterate through the delimiters
-        for delim in delimiters:
-            # Look for the closest index of the delimiter, up to lookahead or
-            # just before the next delimiter with a 16 chars lookahead
-            j = text.find(delim, offset, min(i + 16, offset + lookahead))
-            # Now we've found a closest delimiter, so we use that one
-            if j >= 0 and j < i and (j == 0 or text[j - 1] != escape):
-                i = j
-                d = delim
-        # We have a delimiter, so we can now  yield the result
-        if d is not None:
-            n = len(d)
-            yield DelimiterMatch(i, i + n, d)
-            offset = i + n
-        # We don't have a delimiter, so we need to skip lookahead.
-        # We don't yield any result, as we haven't found a delimiter.
-        else:
-            i = min(offset+lookahead, end)
-            offset = i
-    if offset < end:
-        yield DelimiterMatch(offset, end, None)
+    was found from `offset`, choosing the closest (and then longest) one each
+    time. This is essentially like splitting a string based on a list of
+    delimiters, taking into account an `escape` character. The delimiters can
+    be given as a pattern created with `compileDelimiters`, which avoids
+    recompiling it on each call."""
+    pattern = delimiters if delimiters is None or isinstance(
+        delimiters, re.Pattern) else compileDelimiters(delimiters, escape)
+    if pattern is None:
+        return
+    for match in pattern.finditer(text, offset):
+        yield DelimiterMatch(match.start(), match.end(), match.group())
+
+
+def findUnescaped(text: str, delim: str, offset: int, escape: str) -> int:
+    """Returns the index of the first occurrence of `delim` from `offset`
+    that is not preceded by the `escape` character, or `-1`."""
+    i = text.find(delim, offset)
+    while escape and i > 0 and text[i - 1] == escape:
+        i = text.find(delim, i + 1)
+    return i
 
 
 # FIMXE: This is not used ATM
@@ -268,25 +312,27 @@ def iterMatches(text: str, delimiters: List[Pattern]) -> Iterable[Tuple[int, int
     """Iterates on all the matches from the given regex pattern, using a strategy
     where the largest closest match wins. This is the core of the cherry-picking
     strategy."""
-    matches: List[Tuple[Pattern, Match]] = []
-    # We get all matching delimiter, it's not ideal but we do need to iterate
-    # on all the patterns for all the positions.
-    for pattern in delimiters:
-        matches += [(pattern, _) for _ in pattern.finditer(text)]
-    # We now sort the matches by start and length. The longest match is the one
-    # that will win.
+    # Each pattern gives a stream of matches ordered by start, which we
+    # merge lazily ordering by start and then by decreasing length, so that
+    # the longest match comes first. The pattern index breaks the ties
+    # before the match objects get compared.
+    def stream(index: int, pattern: Pattern):
+        for match in pattern.finditer(text):
+            yield match.start(), match.start() - match.end(), index, match, pattern
+    streams = [stream(i, _) for i, _ in enumerate(delimiters)]
     n = len(text)
-    matches = sorted(matches, key=lambda _: _[
-        1].start() * n + (_[1].end() - _[1].start()))
-    # We start with an offset of -1 (start of text)
+    # We start with an offset of 0 (start of text)
     offset = 0
     # Now we iterate on each match
-    for pattern, match in matches:
-        # The match has (i,j) start and end offsets in the text
-        i, j = match.start(), match.end()
+    for i, _, _, match, pattern in heapq.merge(*streams):
+        # We skip the matches that overlap with the previous one, which
+        # includes the shorter matches at the same position.
+        if i < offset:
+            continue
+        j = match.end()
         # We yield a text match for the inbetween text
         if i != offset:
-            yield 0, i, None, text[offset:i]
+            yield offset, i, None, text[offset:i]
         # We yield the pattern match
         yield i, j, pattern, match
         offset = j
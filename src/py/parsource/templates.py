@@ -1,27 +1,65 @@
 import re
-from typing import Match
+from functools import lru_cache
+from typing import Match, Pattern, Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
 
-RE_SPACES = re.compile(r" +")
-RE_SPECIAL = re.compile(r"\\\:\/\?\*\+")
-RE_TEMPLATE = re.compile(r"^([A-Z_]+)(:([a-z_]+))?$")
+# The `re2` module (from `google-re2`) is optional. When available, we use
+# it to compile templates, as it matches in linear time.
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+# The characters of template slots names and symbols, as in `NAME:symbol`
+TEMPLATE_NAME = "ABCDEFGHIJKLMNOPQRSTUVWXYZ_"
+TEMPLATE_SYMBOL = "abcdefghijklmnopqrstuvwxyz_"
+# The characters escaped in template text, as a translation table so that
+# escaping is done in a single `str.translate` call.
+SPECIAL = "\\:/?*+"
+SPECIAL_ESCAPES = str.maketrans(dict((_, "\\" + _) for _ in SPECIAL))
+# Converting template text to a regexp collapses runs of spaces and escapes
+# the special characters, which we do in a single pass.
+RE_TEXT = re.compile(
+    f"(?P<spaces> +)|(?P<special>[{re.escape(SPECIAL)}])", re.ASCII)
+
+T = TypeVar("T")
+
+
+def parseTemplateSlot(text: str) -> Optional[Tuple[str, str]]:
+    """Parses a template slot like `NAME` or `NAME:symbol`, returning
+    `(name, symbol)`, where the symbol defaults to the lowercase name,
+    or `None` if the text is not a slot."""
+    # Stripping the valid characters is a cheaper check than a regexp
+    name, sep, symbol = text.partition(":")
+    if not name or name.strip(TEMPLATE_NAME) or (sep and (not symbol or symbol.strip(TEMPLATE_SYMBOL))):
+        return None
+    else:
+        return name, (symbol or name).lower()
+
+
+def textToRegExp(match: Match) -> str:
+    """Returns the replacement for a `RE_TEXT` match."""
+    return r"\s+" if match.lastgroup == "spaces" else "\\" + match.group()
 
 
 class Node:
     """Nodes are used in the Parsource AST."""
 
+    __slots__ = ("type", "value", "children", "parent", "cardinality", "_index")
+
     def __init__(self, type: str, value: str = ""):
         self.type = type
         self.value = value
         self.children = []
         self.parent = None
         self.cardinality = ""
+        # The index of the node in its parent's children
+        self._index = -1
 
     @property
     def previous(self):
         if self.parent:
-            siblings = self.parent.children
-            i = siblings.index(self)
-            return siblings[i - 1] if i > 0 else None
+            i = self._index
+            return self.parent.children[i - 1] if i > 0 else None
         else:
             return None
 
@@ -29,43 +67,71 @@ class Node:
     def next(self):
         if self.parent:
             siblings = self.parent.children
-            i = siblings.index(self)
-            return siblings[i + 1] if i < len(siblings) else None
+            i = self._index
+            return siblings[i + 1] if i + 1 < len(siblings) else None
         else:
             return None
 
     def detach(self):
         if self.parent:
-            self.parent.children.remove(self)
+            siblings = self.parent.children
+            del siblings[self._index]
+            for i in range(self._index, len(siblings)):
+                siblings[i]._index = i
             self.parent = None
+            self._index = -1
         return self
 
     def append(self, child: 'Node'):
         assert isinstance(child, Node)
+        child._index = len(self.children)
         self.children.append(child)
         child.parent = self
         return child
 
-    def toRegExp(self):
+    def fold(self, functor: Callable[['Node', List[T]], T]) -> T:
+        """Folds the tree bottom-up, calling `functor(node, values)` with the
+        values of the node's children. This uses an explicit stack rather
+        than recursion."""
+        values: List[T] = []
+        stack: List[Tuple['Node', bool]] = [(self, False)]
+        while stack:
+            node, visited = stack.pop()
+            if not visited:
+                # We'll revisit the node once its children are folded, which
+                # will leave their values at the end of the values list.
+                stack.append((node, True))
+                stack.extend((_, False) for _ in reversed(node.children))
+            else:
+                n = len(node.children)
+                children = values[len(values) - n:]
+                del values[len(values) - n:]
+                values.append(functor(node, children))
+        return values[0]
+
+    def toRegExp(self) -> str:
         """Converts the AST into a regular expression."""
+        return self.fold(Node.assembleRegExp)
+
+    def assembleRegExp(self, children: List[str]) -> str:
+        """Returns the regular expression for this node, given the regular
+        expressions of its children."""
         if self.type == "expr":
-            # When we have an (expr…) node, we just recursively
-            # convert it to a regexp
-            return f"{''.join(_.toRegExp() for _ in self.children)}"
+            # When we have an (expr…) node, we just join the
+            # children regexps
+            return "".join(children)
         elif self.type == "tmpl":
             # Here we have a template (tmpl…)
             groups = []
             sep = ""
-            for node in self.children:
+            for node, regexp in zip(self.children, children):
                 if node.type == "text":
                     # If `tmpl` child is a `text`, we need to see if it
                     # matches `{NAME:TYPE?}``
-                    text = node.value
-                    match = RE_TEMPLATE.match(text)
-                    if match:
+                    slot = parseTemplateSlot(node.value)
+                    if slot:
                         # If it does, great, we can convert it to a named group
-                        name = match.group(1)
-                        symbol = (match.group(3) or match.group(1)).lower()
+                        name, symbol = slot
                         if symbol not in Template.SYMBOLS:
                             raise ValueError(
                                 f"Unsupported symbol '{symbol}' in: {self}")
@@ -74,36 +140,45 @@ class Node:
                                 f"(?P<{name}>{Template.SYMBOLS[symbol]})")
                     else:
                         # Otherwise it's a text, and we just save it as a group
-                        groups.append(node.toRegExp())
+                        groups.append(regexp)
                 elif node.type == "tmpl":
                     # If the node is a nested template, we just append it
                     # as a regexp.
-                    groups.append(node.toRegExp())
+                    groups.append(regexp)
                 elif node.type == "sep":
-                    sep = node.toRegExp()
+                    sep = regexp
                 else:
                     raise ValueError(
                         f"Child '{node.type}' not supported within: {self.type}")
+            if len(groups) > 1 and all(
+                    _.type == "text" and not _.children and not parseTemplateSlot(_.value)
+                    for _ in self.children if _.type != "sep"):
+                # When all the alternatives are literals, we try the longest
+                # first so that `<in|instanceof>` matches the whole keyword
+                # rather than its prefix. The `re` compiler already factors
+                # out the common prefix of the alternatives.
+                groups.sort(key=len, reverse=True)
             res = '|'.join(groups)
             if sep:
                 res = f"({res}){sep}"
             return f"({res}){self.cardinality}"
         elif self.type == "text":
             # If it's  text node, we escape and sub it
-            text = RE_SPECIAL.sub(lambda _: "\\" + _, self.value)
-            text = RE_SPACES.sub(r"\\s+", text)
-            return text + "".join(_.toRegExp() for _ in self.children)
+            return RE_TEXT.sub(textToRegExp, self.value) + "".join(children)
         elif self.type == "sep":
             return r"\s*" if self.cardinality == "?" else r"\s+"
         else:
             raise NotImplementedError(f"Node type not suported: {self.type}")
 
     def __repr__(self):
+        return self.fold(Node.assembleRepr)
+
+    def assembleRepr(self, children: List[str]) -> str:
         res = "(" + self.type
         if self.value:
             res += " " + self.value
-        if self.children:
-            res += " " + " ".join(repr(_) for _ in self.children)
+        if children:
+            res += " " + " ".join(children)
         return res + ")" + self.cardinality
 
 
@@ -117,9 +192,10 @@ class Template:
     }
 
     @classmethod
-    def EscapeSpecial(cls, text: str):
+    def EscapeSpecial(cls, text: str) -> str:
         """Escapes the special characters in the given text, using
-        `RE_SPECIAL`."""
+        `SPECIAL_ESCAPES`."""
+        return text.translate(SPECIAL_ESCAPES)
 
     @classmethod
     def ToRegexp(cls, text: str) -> str:
@@ -135,24 +211,87 @@ class Template:
         return cls.ParseTemplateExpression(text)
 
     @classmethod
-    def Compile(cls, text, separator=' '):
-        return re.compile(cls.Parse(text, separator).toRegExp())
+    @lru_cache(maxsize=512)
+    def Compile(cls, text, separator=' ') -> Pattern:
+        """Compiles the given template expression to a regular expression.
+        Compiled templates are cached, as templates are typically compiled
+        repeatedly from the same few expressions. The pattern is compiled
+        with `re2` when available, falling back to `re` for the expressions
+        it does not support."""
+        regexp = cls.Parse(text, separator).toRegExp()
+        if re2:
+            try:
+                return re2.compile(regexp)
+            except re2.error:
+                pass
+        return re.compile(regexp)
+
+    @classmethod
+    def MatchLines(cls, text: str, lines: Iterable[str], separator=' ') -> List[Optional[Match]]:
+        """Matches each line against the given template, returning the match
+        (or `None`) of each line, in order."""
+        return list(map(cls.Compile(text, separator).match, lines))
 
     @classmethod
-    def Parse(cls, text, separator=' ') -> str:
+    def MatchAny(cls, templates: Iterable[str], lines: Iterable[str], separator=' ') -> Iterator[Tuple[int, str, Match]]:
+        """Matches each line against the given templates, yielding
+        `(index, line, match)` for the first template that matches, where
+        `index` is the index of the template. Lines that no template
+        matches are skipped. Templates are compiled once for all lines."""
+        patterns = [cls.Compile(_, separator).match for _ in templates]
+        for line in lines:
+            for i, match in enumerate(patterns):
+                if m := match(line):
+                    yield i, line, m
+                    break
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def TokensPattern(cls, separator=' ') -> Pattern:
+        """Returns the pattern matching the special characters of the
+        template syntax (`<` unless escaped, `>` and `|`), runs of
+        `separator` and the end of the text. Separators are single
+        characters: any other separator is never matched, and stays in the
+        text."""
+        sep = f"(?:{re.escape(separator)})+|" if len(separator) == 1 else ""
+        return re.compile(f"{sep}(?<!\\\\)<|[>|]|\\Z")
+
+    @classmethod
+    def ClearCache(cls):
+        """Clears the cache of compiled templates, and of tokens patterns."""
+        cls.Compile.cache_clear()
+        cls.TokensPattern.cache_clear()
+
+    @classmethod
+    def Parse(cls, text, separator=' ') -> Node:
         # return f"(?P<{name}>{cls.SYMBOLS[typename[1:]]})"
-        o = 0
-        n = len(text)
         root = Node("expr")
         current: Node = root
         stack = [root]
         last_c = ''
-        while o < n:
-            c = text[o]
+        offset = 0
+        # We only stop on the special characters, the text in between is
+        # added in one go.
+        for match in cls.TokensPattern(separator).finditer(text):
+            start, end = match.span()
+            if offset < start:
+                chunk = text[offset:start]
+                # An escaped `\<` is a literal `<`, so we drop the escape
+                if "\\<" in chunk:
+                    chunk = chunk.replace("\\<", "<")
+                if current.type == "text":
+                    current.value = current.value + chunk
+                else:
+                    current = stack[-1].append(Node("text", chunk))
+                last_c = chunk[-1]
+            if start == end:
+                # This is the end of the text
+                break
+            c = text[start]
             if c == separator:
                 if current.type != "sep":
                     current = current.append(Node("sep"))
-            elif c == "<" and last_c != '\\':
+            elif c == "<":
                 current = stack[-1].append(Node("tmpl"))
                 stack.append(current)
             elif c == ">":
@@ -165,13 +304,9 @@ class Template:
                 current = stack.pop()
             elif c == "|":
                 current = stack[-1].append(Node("text"))
-            elif current.type == "text":
-                current.value = current.value + c
-            else:
-                current = stack[-1].append(Node("text", c))
             # End of iteration
             last_c = c
-            o += 1
+            offset = end
         return root
 
 # EOF - vim: ts=4 sw=4 et
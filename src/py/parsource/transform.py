@@ -1,8 +1,14 @@
 import re
-from typing import Iterable, Tuple, List, Dict, Any, Iterable, Optional
+from collections import deque
+from functools import lru_cache
+from typing import Iterable, Tuple, List, Dict, Any, Iterable, Optional, Match, Pattern
 from parsource.parser import ParseEvent, iterMatches
 from parsource.tree import Node, TreeTransform
 
+# Matches numbered group references, like `\1` or `(?(1)…)`, which don't
+# survive the combination of patterns.
+RE_GROUP_REFERENCE = re.compile(r"(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(\d")
+
 # -----------------------------------------------------------------------------
 #
 # TRANSFORM
@@ -38,6 +44,13 @@ class Transform:
                 yield res
         self.postProcess()
 
+    def drain(self, stream: Iterable[ParseEvent]) -> Any:
+        """Processes the whole stream, discarding the errors, and returns
+        the resulting value."""
+        # A zero-length deque consumes the iterator without storing it
+        deque(self.process(stream), maxlen=0)
+        return self.value
+
 # -----------------------------------------------------------------------------
 #
 # TREE EXTRACTOR
@@ -48,6 +61,17 @@ class Transform:
 class TreeExtractor(Transform):
     """Extracts a tree from the parse stream."""
 
+    # The events that create a leaf node, with the name of the node. These
+    # are the most frequent events, so we resolve them with a single lookup.
+    LEAVES: Dict[str, str] = {
+        ParseEvent.QUOTE: "quote",
+        ParseEvent.TEXT: "text",
+        ParseEvent.KEYWORD: "keyword",
+        ParseEvent.OPERATOR_INFIX: "op-inf",
+        ParseEvent.OPERATOR_SUFFIX: "op-suf",
+        ParseEvent.OPERATOR_PREFIX: "op-pre",
+    }
+
     def __init__(self, offsets=True):
         super().__init__()
         self.withOffsets = offsets
@@ -55,7 +79,10 @@ class TreeExtractor(Transform):
     def reset(self):
         self.value = Node("root")
         self.stack: List[Tuple[Node, str]] = [(self.value, "")]
-        self.normalizer = NormalizeTree()
+        # Maps the id of a node to the number of its children up to its
+        # last statement, so that we don't have to look for it.
+        self.statementBoundary: Dict[int, int] = {}
+        self.normalizer = NormalizeTree.Get()
 
     def postProcess(self):
         # self.normalizer.run(self.value)
@@ -75,6 +102,7 @@ class TreeExtractor(Transform):
 
     def pop(self):
         old = self.stack.pop()[0]
+        self.statementBoundary.pop(old.id, None)
         if not self.stack:
             raise Exception(f"More pops than pushes at {self.stack}")
         else:
@@ -87,38 +115,30 @@ class TreeExtractor(Transform):
         return node
 
     def feed(self, event: ParseEvent) -> Optional[Exception]:
-        if event.type == ParseEvent.COMMENT:
+        event_type = event.type
+        if (name := self.LEAVES.get(event_type)):
+            self.append(self.node(event, name, value=event.text))
+        elif event_type == ParseEvent.COMMENT:
             self.push(self.append(self.node(event, "comment")),
                       ParseEvent.LINE_END)
-        elif event.type == ParseEvent.BLOCK_START:
+        elif event_type == ParseEvent.BLOCK_START:
             self.push(self.append(
-                self.node(event, "block", type=event.value)), event.type)
-        elif event.type == ParseEvent.LINE_END:
+                self.node(event, "block", type=event.value)), event_type)
+        elif event_type == ParseEvent.LINE_END:
             if self.currentEvent == ParseEvent.LINE_END:
                 self.pop()
-        elif event.type == ParseEvent.STATEMENT_END:
+        elif event_type == ParseEvent.STATEMENT_END:
             # A statement will integrate the any previous sibling of the
-            # current node that is not a statement.
-            prev_statement = next((i for i, n in enumerate(
-                reversed(self.current.children)) if n.name == "statement"), 0)
+            # current node that is not a statement, which are the ones
+            # after the last statement.
+            current = self.current
             node = self.node(event, "statement")
-            for child in self.current.children[prev_statement:]:
-                node.add(child.detach())
+            node.extend(current.removeRange(
+                self.statementBoundary.get(current.id, 0), current.count))
             self.append(node)
-        elif event.type == ParseEvent.BLOCK_END:
+            self.statementBoundary[current.id] = current.count
+        elif event_type == ParseEvent.BLOCK_END:
             self.pop()
-        elif event.type == ParseEvent.QUOTE:
-            self.append(self.node(event, "quote", value=event.text))
-        elif event.type == ParseEvent.TEXT:
-            self.append(self.node(event, "text", value=event.text))
-        elif event.type == ParseEvent.KEYWORD:
-            self.append(self.node(event, "keyword", value=event.text))
-        elif event.type == ParseEvent.OPERATOR_INFIX:
-            self.append(self.node(event, "op-inf", value=event.text))
-        elif event.type == ParseEvent.OPERATOR_SUFFIX:
-            self.append(self.node(event, "op-suf", value=event.text))
-        elif event.type == ParseEvent.OPERATOR_PREFIX:
-            self.append(self.node(event, "op-pre", value=event.text))
         else:
             raise ValueError(f"Unsupported event: {event}")
 
@@ -143,11 +163,66 @@ class TreeExtractor(Transform):
 
 class CommentProcessor(TreeTransform):
 
+    # The patterns are combined in a single regexp, where the first listed
+    # pattern that matches at a given position wins, so longer patterns
+    # need to be listed first. Patterns with flags or numbered group
+    # references can't be combined, and when there are any, the patterns
+    # are scanned separately with `iterMatches`, where the longest match
+    # wins.
     PATTERNS = {
         (re.compile("@(?P<value>[a-z][a-z0-9]+)")): "directive",
         (re.compile(r"--\s+|―\s*")): "separator",
     }
 
+    @classmethod
+    @lru_cache(maxsize=None)
+    def CombinedPattern(cls) -> Optional[Tuple[Pattern, Dict[str, Tuple[str, Optional[str]]]]]:
+        """Returns the class's `PATTERNS` combined in a single regexp, so
+        that comment text is scanned once, along with a map of the group
+        of each pattern to its node name and to the group of its value.
+        Returns `None` when the patterns can't be combined."""
+        groups = []
+        names: Dict[str, Tuple[str, Optional[str]]] = {}
+        for i, (pattern, name) in enumerate(cls.PATTERNS.items()):
+            # Flags apply to the whole regexp, and group numbers are
+            # shifted by the other patterns' groups.
+            if pattern.flags & ~re.UNICODE or RE_GROUP_REFERENCE.search(pattern.pattern):
+                return None
+            group = f"p{i}"
+            # The named groups of each pattern are prefixed with the
+            # pattern's group, so that patterns can reuse the same names.
+            groups.append(f"(?P<{group}>" + re.sub(
+                r"\(\?P([<=])(\w+)",
+                lambda _: f"(?P{_.group(1)}{group}_{_.group(2)}",
+                pattern.pattern) + ")")
+            names[group] = (
+                name, f"{group}_value" if "value" in pattern.groupindex else None)
+        return re.compile("|".join(groups)), names
+
+    def iterSpans(self, text: str) -> Iterable[Tuple[int, int, Optional[str], Optional[str]]]:
+        """Iterates on the `(start, end, name, value)` spans of the pattern
+        matches in the text, and of the text in between, where the name
+        is `None`."""
+        if combined := self.CombinedPattern():
+            pattern, names = combined
+            offset = 0
+            for match in pattern.finditer(text):
+                if offset < match.start():
+                    yield offset, match.start(), None, text[offset:match.start()]
+                name, group = names[match.lastgroup]
+                yield match.start(), match.end(), name, match.group(group) if group else None
+                offset = match.end()
+            if offset < len(text):
+                yield offset, len(text), None, text[offset:]
+        else:
+            for start, end, pattern, match in iterMatches(text, list(self.PATTERNS)):
+                if pattern:
+                    value = match.group(
+                        "value") if "value" in pattern.groupindex else None
+                    yield start, end, self.PATTERNS[pattern], value
+                else:
+                    yield start, end, None, match
+
     def on_block(self, node: Node):
         if node["type"] == "(":
             args = [Node("text", value=_.strip()) for _ in "".join(
@@ -161,16 +236,8 @@ class CommentProcessor(TreeTransform):
         text = node["value"]
         res = []
         assert node.count == 0, f"Text node has children, but should not have: {node}"
-        for start, end, pattern, match in iterMatches(text, list(self.PATTERNS.keys())):
-            if pattern:
-                child = Node(self.PATTERNS[pattern])
-                try:
-                    value = match.group("value")
-                except IndexError as e:
-                    value = None
-            else:
-                child = Node("text")
-                value = text[start:end]
+        for start, end, name, value in self.iterSpans(text):
+            child = Node(name or "text")
             if value:
                 child.setAttribute("value", value)
             res.append(child.updateAttributes(dict(
@@ -185,8 +252,6 @@ class CommentProcessor(TreeTransform):
 class NormalizeTree(TreeTransform):
     """Normalizes the tree."""
 
-    Comments = CommentProcessor()
-
     def on_text(self, node):
         """We move text back into statements."""
         if node.parent.name != "statement":
@@ -194,8 +259,14 @@ class NormalizeTree(TreeTransform):
 
     def on_statement(self, node):
         """We absorb statement text siblings"""
-        while node.nextSibling and node.nextSibling.name == "text":
-            node.append(node.nextSibling.detach())
+        if parent := node.parent:
+            # We look for the consecutive text siblings and move them all
+            # at once.
+            siblings = parent.children
+            start = end = node.index() + 1
+            while end < len(siblings) and siblings[end].name == "text":
+                end += 1
+            node.extend(parent.removeRange(start, end))
         if not node.count:
             node.detach()
 
@@ -203,7 +274,7 @@ class NormalizeTree(TreeTransform):
         pass
 
     def on_comment(self, node: Node):
-        self.Comments.process(node)
+        CommentProcessor.Get().process(node)
         # This essentially merges the comment back to its parent
         # ├─ comment start=0 end=2
         # │  ├─ directive value='function' start=3 end=12
@@ -216,8 +287,7 @@ class NormalizeTree(TreeTransform):
         # │  ├─ text value=' Some function' start=12 end=26
         # │  └─ text value='with a documentation there' start=30 end=56
         if node.previousSibling and node.firstChild and node.firstChild.name != "directive":
-            for child in node.children:
-                node.previousSibling.append(child.detach())
+            node.previousSibling.extend(node.removeRange(0, node.count))
             node.detach()
 
     # FIXME: This does not work because that does not recurse. We should
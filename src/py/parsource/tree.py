@@ -1,9 +1,18 @@
-from typing import Optional, Any, List, Dict, Union, Iterator, Iterable, Callable
+from typing import Optional, Any, List, Dict, Tuple, Union, Iterator, Iterable, Callable, Mapping
+from types import MappingProxyType
+from functools import lru_cache
+import itertools
 import json
-import inspect
 
 # NOTE: This module was initially copied from TLang.
 
+
+@lru_cache(maxsize=4096)
+def jsonString(value: str) -> str:
+    """Returns the JSON string for the given value. Attribute values are
+    often repeated, so we cache the encoded strings."""
+    return json.dumps(value)
+
 # -----------------------------------------------------------------------------
 #
 # NODE
@@ -15,18 +24,25 @@ class Node:
     """A node is an uniquely identified, named object with zero or one parent,
     a set of attributes and a list of children."""
 
-    IDS = 0
+    # Generates the unique node ids
+    ID = itertools.count()
+
+    # Trees can have many nodes, so we use slots to keep nodes small.
+    __slots__ = ("name", "id", "parent", "attributes", "_children",
+                 "_index", "metadata")
 
     def __init__(self, name: str, **attributes):
         assert isinstance(
             name, str), f"Node name must be a string, got: {name}"
         self.name = name
-        self.id = Node.IDS
-        Node.IDS += 1
+        self.id = next(Node.ID)
         self.parent: Optional['Node'] = None
         # FIXME: This does not support namespaces for attributes
         self.attributes: Dict[str, Any] = attributes
         self._children: List['Node'] = []
+        # The index of the node in its parent's children, maintained by the
+        # parent so that sibling access does not need to look it up.
+        self._index: int = -1
         self.metadata: Optional[Dict[str, Any]] = None
 
     @property
@@ -70,16 +86,15 @@ class Node:
     def previousSibling(self) -> Optional['Node']:
         if not self.parent:
             return None
-        siblings = self.parent.children
-        i = siblings.index(self)
-        return siblings[i - 1] if i > 0 else None
+        i = self._index
+        return self.parent._children[i - 1] if i > 0 else None
 
     @property
     def nextSibling(self) -> Optional['Node']:
         if not self.parent:
             return None
-        siblings = self.parent.children
-        i = siblings.index(self)
+        siblings = self.parent._children
+        i = self._index
         return siblings[i + 1] if i + 1 < len(siblings) else None
 
     @property
@@ -120,20 +135,37 @@ class Node:
     def copy(self, depth=-1):
         """Does a deep copy of this node. If a depth is given, it will
         stop at the given depth."""
-        node = Node(self.name)
-        self.attributes = type(self.attributes)((k, v)
-                                                for k, v in self.attributes.items())
-        if depth != 0:
-            for child in self._children:
-                node.append(child.copy(depth - 1))
+        def shallow(source: Node) -> Node:
+            # Attributes are assigned rather than passed as keywords, as
+            # they may include a `name` attribute.
+            node = Node(source.name)
+            node.attributes = dict(source.attributes)
+            return node
+        node = shallow(self)
+        # We copy the subtree using a stack rather than recursion, with the
+        # remaining depth for each source node.
+        stack = [(self, node, depth)]
+        while stack:
+            source, copy, d = stack.pop()
+            if d != 0:
+                for child in source._children:
+                    stack.append((child, copy.add(shallow(child)), d - 1))
         return node
 
     def index(self, node=None) -> Optional[int]:
         if not node:
-            return self.parent.index(self) if self.parent else None
+            return self._index if self.parent else None
+        elif node.parent is self:
+            return node._index
         else:
             return self._children.index(node)
 
+    def _reindex(self, start: int = 0):
+        """Updates the index of the children from `start`."""
+        children = self._children
+        for i in range(start, len(children)):
+            children[i]._index = i
+
     def detach(self) -> 'Node':
         if self.parent:
             self.parent.remove(self)
@@ -171,6 +203,7 @@ class Node:
         assert not node.parent, "Cannot add node to {0}, it already has a parent: {1}".format(
             self, node)
         node.parent = self
+        node._index = len(self._children)
         self._children.append(node)
         return node
 
@@ -187,13 +220,16 @@ class Node:
             previous = self._children[i]
             self._children[i] = node
             previous.parent = None
+            previous._index = -1
             node.parent = self
+            node._index = i
             return node
 
     def setChildren(self, children: Iterable['Node']):
         if self.children:
             for child in self.children:
                 child.parent = None
+                child._index = -1
             self._children = []
         for child in children:
             self.append(child)
@@ -210,10 +246,25 @@ class Node:
     def remove(self, node: 'Node') -> 'Node':
         assert node.parent is self, "Cannot remove node from {0}, it has a different parent: {1}".format(
             self, node.parent)
+        i = node._index
         node.parent = None
-        self._children.remove(node)
+        node._index = -1
+        del self._children[i]
+        self._reindex(i)
         return node
 
+    def removeRange(self, start: int, end: int) -> List['Node']:
+        """Removes the children from `start` to `end` (excluded) at once,
+        returning them."""
+        removed = list(self._children[start:end])
+        if removed:
+            del self._children[start:end]
+            for node in removed:
+                node.parent = None
+                node._index = -1
+            self._reindex(start)
+        return removed
+
     def insert(self, index: int, node: 'Node') -> 'Node':
         index = index if index >= 0 else len(self._children) + index
         assert index >= 0 and index <= len(
@@ -222,9 +273,11 @@ class Node:
             self, node)
         node.parent = self
         if index == len(self._children):
+            node._index = index
             self._children.append(node)
         else:
             self._children.insert(index, node)
+            self._reindex(index)
         return node
 
     def replaceWith(self, nodes: Union['Node', List['Node']]):
@@ -246,10 +299,14 @@ class Node:
         return list(p(_) for _ in self.iterWalk(functor))
 
     def iterWalk(self, functor=None):
-        if (not functor) or functor(self) is not False:
-            yield self
-            for c in self._children:
-                yield from c.iterWalk(functor)
+        # We use an explicit stack rather than recursion, so that walking
+        # deep trees does not create a generator per level.
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if (not functor) or functor(node) is not False:
+                yield node
+                stack.extend(reversed(node._children))
 
     def toPrimitive(self):
         res = {"id": self.id}
@@ -275,9 +332,8 @@ class Node:
                 yield ""
                 stop = True
         if not stop:
-            attributes = " ".join(
-                f"{k}={json.dumps(v) if isinstance(v,str) else json.dumps(json.dumps(v))}" for k, v in self.attributes.items())
-            prefix = f"{self.name}{' ' if attributes else ''}{attributes}"
+            prefix = f"{self.name} " + " ".join(
+                f"{k}={jsonString(v) if isinstance(v,str) else json.dumps(json.dumps(v))}" for k, v in self.attributes.items()) if self.attributes else self.name
             if not self._children:
                 yield f"<{prefix} />"
             else:
@@ -290,15 +346,27 @@ class Node:
         return "".join(self.iterXML())
 
     def iterTDoc(self, level=0) -> Iterable[str]:
-        attributes = " ".join(f"{k}={repr(v)}" for k,
-                              v in self.attributes.items())
-        yield f"{self.name or '┐'} {attributes}"
-        last_i = len(self.children) - 1
-        for i, child in enumerate(self.children):
-            for j, line in enumerate(child.iterTDoc(level + 1)):
-                leader = ("└─ " if i == last_i else "├─ ") if j == 0 else (
-                    "   " if i == last_i else "│  ")
-                yield leader + line
+        # Each stack entry holds the leader of the node's line and the
+        # indent of its descendants' lines, so that each line is built
+        # once, rather than once per ancestor.
+        stack: List[Tuple[Node, str, str]] = [(self, "", "")]
+        while stack:
+            node, leader, indent = stack.pop()
+            attributes = " ".join(f"{k}={repr(v)}" for k,
+                                  v in node.attributes.items())
+            yield f"{leader}{node.name or '┐'} {attributes}"
+            if children := node._children:
+                last = children[-1]
+                stack.append((last, indent + "└─ ", indent + "   "))
+                stack.extend((_, indent + "├─ ", indent + "│  ")
+                             for _ in reversed(children[:-1]))
+
+    def writeTDoc(self, out):
+        """Writes the TDoc lines to the `out` stream, as they are produced."""
+        write = out.write
+        for line in self.iterTDoc():
+            write(line)
+            write("\n")
 
     def toTDoc(self) -> str:
         return "\n".join(self.iterTDoc())
@@ -338,12 +406,34 @@ class TreeProcessor:
     META_MATCH = "__tlang_model_treebuilder_match"
     PREFIX = ""
     INSTANCE = None
+    # Maps node names to handler functions, see `__init_subclass__`
+    DISPATCH: Mapping[str, Callable[..., Any]] = MappingProxyType({})
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # We build the dispatch table once per class, from all the members
+        # of the class, including the inherited ones, so that the class's
+        # `PREFIX` applies to every handler. Members are visited by name,
+        # like `inspect.getmembers` does.
+        members: Dict[str, Any] = {}
+        for klass in reversed(cls.__mro__):
+            members.update(klass.__dict__)
+        dispatch: Dict[str, Callable[..., Any]] = {}
+        for name, value in sorted(members.items()):
+            if hasattr(value, TreeProcessor.META_MATCH):
+                dispatch[getattr(value, TreeProcessor.META_MATCH)] = value
+            elif name.startswith("on_") and callable(value):
+                dispatch[cls.PREFIX +
+                         name[3:].replace("__", ":").replace("_", "-")] = value
+        cls.DISPATCH = MappingProxyType(dispatch)
 
     @classmethod
     def Get(cls):
-        if not cls.INSTANCE:
-            cls.INSTANCE = cls()
-        return cls.INSTANCE
+        """Returns the shared instance of this processor class. Instances
+        are per class, and not inherited from the parent class."""
+        if not (instance := cls.__dict__.get("INSTANCE")):
+            instance = cls.INSTANCE = cls()
+        return instance
 
     @staticmethod
     def Match(name: str):
@@ -353,15 +443,7 @@ class TreeProcessor:
         return decorator
 
     def __init__(self):
-        self.matches: Dict[str,
-                           Callable[TreeProcessor, Node, Iterable[Any]]] = {}
         self.node: Optional[Node] = Node
-        for name, value in inspect.getmembers(self):
-            if hasattr(value, TreeProcessor.META_MATCH):
-                self.matches[getattr(value, TreeProcessor.META_MATCH)] = value
-            elif name.startswith("on_"):
-                self.matches[self.PREFIX +
-                             name[3:].replace("__", ":").replace("_", "-")] = value
         self.init()
 
     def init(self):
@@ -387,10 +469,10 @@ class TreeProcessor:
     def feed(self, node: Node) -> Iterable[Any]:
         # TODO: Support namespace
         name = node.name
-        func = self.matches.get(name)
+        func = self.DISPATCH.get(name)
         self.node = node
         if func:
-            result = func(node)
+            result = func(self, node)
             if result is None:
                 pass
             elif isinstance(result, Iterator):
@@ -2,12 +2,14 @@ from parsource.lang.js import JavaScriptExpression
 from parsource.parser import ExpressionParser
 from parsource.transform import TreeExtractor
 
+# The grammar tables are built once, and the parser and extractor are reused
+parser = ExpressionParser(JavaScriptExpression())
+extractor = TreeExtractor(offsets=False)
+
 
 def parse(text: str):
-    extractor = TreeExtractor(offsets=False)
-    parser = ExpressionParser(JavaScriptExpression())
-    errors = [_ for _ in extractor.process(parser.parse(text))]
-    return extractor.value
+    extractor.reset()
+    return extractor.drain(parser.parse(text))
 
 
 #            0123456789
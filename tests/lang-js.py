@@ -1,11 +1,14 @@
+from parsource.parser import BlockParser
 from parsource.transform import TreeExtractor
 from parsource.lang.js import JavaScriptBlocks
 
+JavaScript = BlockParser(JavaScriptBlocks())
+extractor = TreeExtractor(offsets=False)
+
 
 def parse(text: str):
-    extractor = TreeExtractor(offsets=False)
-    errors = [_ for _ in extractor.process(JavaScript.parse(text))]
-    return extractor.value
+    extractor.reset()
+    return extractor.drain(JavaScript.parse(text))
 
 
 print(parse("let a = 10;const b = 20;").toTDoc())
@@ -0,0 +1,59 @@
+from parsource.parser import BlockLanguage, BlockParser, ExpressionParser, ParseEvent
+from parsource.lang.js import JavaScriptExpression
+
+parser = BlockParser(BlockLanguage())
+
+
+def events(text: str):
+    return [(_.type, _.text) for _ in parser.parse(text)]
+
+
+# @group Text
+# Text between delimiters is trimmed, and blank text yields no event
+res = events("  a = 1 ;\n  b  ")
+assert res == [
+    (ParseEvent.TEXT, "a = 1"),
+    (ParseEvent.STATEMENT_END, ";"),
+    (ParseEvent.LINE_END, "\n"),
+    (ParseEvent.TEXT, "b"),
+], res
+assert events(" \t\n") == [(ParseEvent.LINE_END, "\n")], events(" \t\n")
+
+# @group Quotes
+# Delimiters within quotes are skipped, as are escaped quotes
+res = events('a "b; \\" (c" d')
+assert res == [
+    (ParseEvent.TEXT, "a"),
+    (ParseEvent.QUOTE, '"b; \\" (c"'),
+    (ParseEvent.TEXT, "d"),
+], res
+# An unterminated quote swallows the rest of the text
+res = events('a; "b; c')
+assert res == [
+    (ParseEvent.TEXT, "a"),
+    (ParseEvent.STATEMENT_END, ";"),
+], res
+
+# @group Delimiters
+# The longest delimiter wins, so `"""` is not read as an empty quote
+res = events('"""a"""b')
+assert res == [
+    (ParseEvent.QUOTE, '"""a"""'),
+    (ParseEvent.TEXT, "b"),
+], res
+res = events("/* a */")
+assert res == [
+    (ParseEvent.BLOCK_START, "/*"),
+    (ParseEvent.TEXT, "a"),
+    (ParseEvent.BLOCK_END, "*/"),
+], res
+# Expressions also prefer the longest operator, `!==` over `!=`
+res = [(_.type, _.text) for _ in ExpressionParser(
+    JavaScriptExpression()).parse("a!==b")]
+assert res == [
+    (ParseEvent.TEXT, "a"),
+    (ParseEvent.OPERATOR_INFIX, "!=="),
+    (ParseEvent.TEXT, "b"),
+], res
+
+# EOF
@@ -1,5 +1,9 @@
+import os
 from parsource import Template
 
+# Set `VERBOSE=1` to print the parsed templates and their regexps
+VERBOSE = bool(os.environ.get("VERBOSE"))
+
 # @group Parsing templates
 EXPRESSIONS = {
     "<export?> class <NAME>": "(expr (tmpl (text export) (sep))? (text class (sep)) (tmpl (text NAME)))",
@@ -9,9 +13,10 @@ EXPRESSIONS = {
 for expr, template in EXPRESSIONS.items():
     t = Template.Parse(expr)
     assert repr(t) == template, f"Template is '{t}', expected: {template}"
-    print(expr)
-    print(" → ", t)
-    print(" → ", t.toRegExp())
+    if VERBOSE:
+        print(expr)
+        print(" → ", t)
+        print(" → ", t.toRegExp())
 
 # @group Matching templates
 MATCHING = {
@@ -36,4 +41,31 @@ for template, matching in MATCHING.items():
     for line in matching:
         assert t.match(line), f"Line not recognized by '{template}': {line}"
 
+# Matching a batch of lines gives the match of each line, in order
+matches = Template.MatchLines("var <NAME>", ["var a", "let b", "var c"])
+assert [_ and _.group("NAME") for _ in matches] == ["a", None, "c"], matches
+
+# Separators are single characters, others are kept as text
+assert repr(Template.Parse("a__b <C>", "__")) == "(expr (text a__b ) (tmpl (text C)))", repr(Template.Parse("a__b <C>", "__"))
+assert repr(Template.Parse("ab", "")) == "(expr (text ab))", repr(Template.Parse("ab", ""))
+
+# An escaped `<` is matched literally, without its escape
+assert repr(Template.Parse(r"a \<NAME>")) == "(expr (text a (sep)) (text <NAME))", repr(Template.Parse(r"a \<NAME>"))
+assert Template.Compile(r"a \<NAME>").match("a <NAME")
+assert not Template.Compile(r"a \<NAME>").match(r"a \<NAME")
+
+# Literal alternatives match the longest keyword first
+assert Template.Compile("<in|instanceof>").match("instanceof").group() == "instanceof"
+
+# The first matching template wins, and unmatched lines are skipped
+matched = [(i, line) for i, line, _ in Template.MatchAny(
+    ["var <NAME><>=<>", "<var|const|let> <NAME>"],
+    ["var foo = 1", "let foo", "foo"])]
+assert matched == [(0, "var foo = 1"), (1, "let foo")], f"Matched: {matched}"
+
+# @group Caching templates
+assert Template.Compile("var <NAME>") is Template.Compile("var <NAME>")
+Template.ClearCache()
+assert Template.Compile.cache_info().currsize == 0
+
 # EOF
@@ -0,0 +1,61 @@
+import re
+from parsource.tree import Node
+from parsource.transform import CommentProcessor
+
+# @group Comment patterns
+
+
+def comment(processor: CommentProcessor, text: str) -> Node:
+    root = Node("comment")
+    root.add(Node("text", value=text, start=0, end=len(text)))
+    processor.process(root)
+    return root
+
+
+res = comment(CommentProcessor(), "See @param -- here")
+assert [(_.name, _.attributes.get("value")) for _ in res.children] == [
+    ("text", "See "), ("directive", "param"), ("text", " "), ("separator", None), ("text", "here")], res.toTDoc()
+
+
+# Subclasses scan with their own patterns, which can all have a value
+class TagProcessor(CommentProcessor):
+    PATTERNS = {
+        re.compile("@(?P<value>[a-z]+)"): "directive",
+        re.compile("#(?P<value>[a-z]+)"): "tag",
+    }
+
+
+res = comment(TagProcessor(), "@see #todo -- ")
+assert [(_.name, _.attributes.get("value")) for _ in res.children] == [
+    ("directive", "see"), ("text", " "), ("tag", "todo"), ("text", " -- ")], res.toTDoc()
+
+
+# When combined, the first listed pattern that matches wins
+class MentionProcessor(CommentProcessor):
+    PATTERNS = {
+        re.compile("@a"): "mention",
+        re.compile("@(?P<value>[a-z]+)"): "directive",
+    }
+
+
+res = comment(MentionProcessor(), "@abc")
+assert [(_.name, _.attributes.get("value")) for _ in res.children] == [
+    ("mention", None), ("text", "bc")], res.toTDoc()
+
+
+# Patterns with flags or numbered group references are scanned separately,
+# where the longest match wins.
+class FlaggedProcessor(CommentProcessor):
+    PATTERNS = {
+        re.compile("@a"): "mention",
+        re.compile("@(?P<value>[a-z]+)", re.I): "directive",
+        re.compile(r"(-)\1"): "separator",
+    }
+
+
+assert FlaggedProcessor.CombinedPattern() is None
+res = comment(FlaggedProcessor(), "@TODO -- @abc")
+assert [(_.name, _.attributes.get("value")) for _ in res.children] == [
+    ("directive", "TODO"), ("text", " "), ("separator", None), ("text", " "), ("directive", "abc")], res.toTDoc()
+
+# EOF
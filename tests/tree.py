@@ -0,0 +1,77 @@
+from io import StringIO
+from parsource.tree import Node, TreeProcessor
+
+# @group Copying nodes
+root = Node("root", value="r")
+a = root.add(Node("a", value="a"))
+a.add(Node("b", value="b"))
+root.add(Node("c"))
+
+copy = root.copy()
+assert copy is not root
+assert copy.attributes == root.attributes
+assert copy.attributes is not root.attributes
+assert copy.toTDoc() == root.toTDoc(), f"Copy is '{copy.toTDoc()}', expected: {root.toTDoc()}"
+assert [_.name for _ in copy.children] == ["a", "c"]
+assert copy.children[0].children[0].parent is copy.children[0]
+assert root.copy(0).count == 0
+assert root.copy(1).children[0].count == 0
+# A `name` attribute is not confused with the node name
+named = Node("x")
+named.setAttribute("name", "y")
+named.add(Node("z")).setAttribute("name", "w")
+assert named.copy().toTDoc() == named.toTDoc()
+
+# @group Children
+# Leaves have a list of children, like any other node
+leaf = Node("leaf")
+assert leaf.children + [root] == [root]
+assert root.children.copy() == root.children
+
+# @group Writing TDoc
+assert root.toTDoc() == "root value='r'\n├─ a value='a'\n│  └─ b value='b'\n└─ c ", root.toTDoc()
+out = StringIO()
+root.writeTDoc(out)
+assert out.getvalue() == root.toTDoc() + "\n"
+
+# @group Removing children
+parent = Node("parent")
+children = [parent.add(Node(str(i))) for i in range(5)]
+removed = parent.removeRange(1, 3)
+assert removed == children[1:3]
+assert all(not _.parent for _ in removed)
+assert [_.name for _ in parent.children] == ["0", "3", "4"]
+assert [_.index() for _ in parent.children] == [0, 1, 2]
+assert children[3].previousSibling is children[0]
+
+# @group Shared processors
+class Processor(TreeProcessor):
+    pass
+
+
+class SubProcessor(Processor):
+    pass
+
+
+assert Processor.Get() is Processor.Get()
+assert type(SubProcessor.Get()) is SubProcessor
+assert Processor.Get() is not SubProcessor.Get()
+
+# Handlers are keyed with the class's prefix, including inherited ones
+class TextProcessor(TreeProcessor):
+    def on_text(self, node):
+        return node.name
+
+    def on_block__start(self, node):
+        return node.name
+
+
+class PrefixedProcessor(TextProcessor):
+    PREFIX = "js:"
+
+
+assert sorted(TextProcessor.DISPATCH) == ["block:start", "text"]
+assert sorted(PrefixedProcessor.DISPATCH) == ["js:block:start", "js:text"]
+assert PrefixedProcessor.Get().process(Node("js:text")) == "js:text"
+
+# EOF